@@ -1,16 +1,18 @@
 import logging
 import sys
 from pathlib import Path
-from typing import Tuple, Mapping, Iterable, Any, Optional
+from typing import Tuple, Mapping, MutableMapping, Iterable, Any, Optional, Sequence
 
 import networkx
-from attr import attrib, attrs
-from attr.validators import instance_of, optional
-from more_itertools import windowed
+import numpy as np
+from attr import attrib, attrs, Factory
+from attr.validators import instance_of
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
 
 from know_direction.travel_speed import SpeedInfo, DEFAULT_SPEED_INFO, TravelMode, ON_HORSE_AND_ROWING_SPEED_INFO
 from know_direction.waypoint_graph import WaypointGraph
-from know_direction.world_geography import GeoPoint, WorldGeography, RiverPoint
+from know_direction.world_geography import GeoPoint, WorldGeography
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -21,18 +23,88 @@ TRAVEL_MODE = "travel_mode"
 
 
 def decorate_with_travel_time_in_place(waypoint_graph: networkx.DiGraph, speeds: SpeedInfo) -> None:
-    for (_, _, edge_attributes) in waypoint_graph.edges.data():
-        edge_attributes[TIME_ATTRIBUTE] = speeds.distance_to_travel_time_in_days(
-            distance_in_miles=edge_attributes[DISTANCE_ATTRIBUTE],
-            travel_mode=edge_attributes[TRAVEL_MODE]
-        )
+    edge_attribute_dicts = [edge_attributes
+                            for (_, _, edge_attributes) in waypoint_graph.edges.data()]
+    num_edges = len(edge_attribute_dicts)
 
+    distances = np.fromiter(
+        (edge_attributes[DISTANCE_ATTRIBUTE] for edge_attributes in edge_attribute_dicts),
+        dtype=np.float64, count=num_edges)
+    travel_mode_ids = np.fromiter(
+        (edge_attributes[TRAVEL_MODE].value for edge_attributes in edge_attribute_dicts),
+        dtype=np.int8, count=num_edges)
 
-def pretty_print_path(wayppint_graph: networkx.DiGraph, path: Tuple[GeoPoint]) -> None:
+    inverse_speed_lut = np.zeros(max(mode.value for mode in TravelMode) + 1)
+    for (travel_mode, inverse_speed) in speeds.inverse_speed_by_mode.items():
+        inverse_speed_lut[travel_mode.value] = inverse_speed
+
+    travel_times = distances * inverse_speed_lut[travel_mode_ids]
+    for (edge_attributes, travel_time) in zip(edge_attribute_dicts, travel_times):
+        edge_attributes[TIME_ATTRIBUTE] = float(travel_time)
+
+
+@attrs
+class TravelTimeRouter:
+    """
+    Shortest-travel-time routing over a CSR encoding of the waypoint graph.
+
+    Converting the graph to a SciPy sparse matrix of travel times keyed by
+    integer node indices lets `scipy.sparse.csgraph.dijkstra` run the search in
+    C instead of NetworkX's Python-level Dijkstra.
+    """
+    _points: Sequence[GeoPoint] = attrib()
+    _travel_time_matrix: csr_matrix = attrib(validator=instance_of(csr_matrix))
+    # Dijkstra from one source answers every destination, so repeated queries
+    # from the same source reuse its predecessor array
+    _predecessors_by_source_index: MutableMapping[int, np.ndarray] = attrib(
+        init=False, default=Factory(dict))
+
+    @staticmethod
+    def create_from(waypoint_graph: networkx.DiGraph,
+                    points: Sequence[GeoPoint]) -> "TravelTimeRouter":
+        """
+        The graph's nodes must be the point_id integers indexing `points`, so
+        they double as CSR matrix indices directly.
+        """
+        (rows, cols, travel_times) = zip(
+            *((source_id, target_id, edge_attributes[TIME_ATTRIBUTE])
+              for (source_id, target_id, edge_attributes) in waypoint_graph.edges.data()))
+        travel_time_matrix = csr_matrix(
+            (travel_times, (rows, cols)), shape=(len(points), len(points)))
+        return TravelTimeRouter(points, travel_time_matrix)
+
+    def number_of_strongly_connected_components(self) -> int:
+        (num_components, _) = connected_components(self._travel_time_matrix,
+                                                   connection="strong")
+        return num_components
+
+    def shortest_path(self, source: GeoPoint, destination: GeoPoint) -> Tuple[GeoPoint, ...]:
+        source_index = source.point_id
+        destination_index = destination.point_id
+
+        predecessors = self._predecessors_by_source_index.get(source_index)
+        if predecessors is None:
+            (_, predecessors) = dijkstra(self._travel_time_matrix, indices=source_index,
+                                         return_predecessors=True)
+            self._predecessors_by_source_index[source_index] = predecessors
+
+        path_indices = [destination_index]
+        while path_indices[-1] != source_index:
+            predecessor = predecessors[path_indices[-1]]
+            if predecessor < 0:
+                raise RuntimeError(
+                    f"No path from {source.pretty_string()} to {destination.pretty_string()}")
+            path_indices.append(predecessor)
+        path_indices.reverse()
+
+        return tuple(self._points[index] for index in path_indices)
+
+
+def pretty_print_path(waypoint_graph: networkx.DiGraph, path: Tuple[GeoPoint]) -> None:
 
     print(f"Start in {path[0].pretty_string()}")
 
-    steps = _to_canonical_step_sequence(path)
+    steps = _to_canonical_step_sequence(waypoint_graph, path)
 
     total_time = 0.0
     for step in steps:
@@ -43,68 +115,95 @@ def pretty_print_path(wayppint_graph: networkx.DiGraph, path: Tuple[GeoPoint]) -
 
 
 
-@attrs
+# Constructed once per path hop, so slotted and validator-free like GeoPoint
+@attrs(slots=True)
 class DirectionsStep:
-    source: GeoPoint = attrib(validator=instance_of(GeoPoint))
-    destination: GeoPoint = attrib(validator=instance_of(GeoPoint))
-    distance: float = attrib(validator=instance_of(float))
-    travel_time: float = attrib(validator=instance_of(float))
-    travel_mode: TravelMode = attrib(validator=instance_of(TravelMode))
-    river_name: Optional[str] = attrib(validator=optional(instance_of(str)),
-                                       default=None, kw_only=True)
+    source: GeoPoint = attrib()
+    destination: GeoPoint = attrib()
+    distance: float = attrib()
+    travel_time: float = attrib()
+    travel_mode: TravelMode = attrib()
+    river_name: Optional[str] = attrib(default=None, kw_only=True)
 
 
-def _to_canonical_step_sequence(path: Tuple[GeoPoint]) -> Iterable[DirectionsStep]:
+def _to_canonical_step_sequence(waypoint_graph: networkx.DiGraph,
+                                path: Tuple[GeoPoint]) -> Iterable[DirectionsStep]:
     if len(path) < 2:
         raise RuntimeError("Path length cannot be less than 2")
-    river_buffer = []
-    steps = []
-
-    def should_extend_river_buffer_with(step: DirectionsStep) -> bool:
-        is_river_edge = isinstance(step.source, RiverPoint) and isinstance(step.destination, RiverPoint)
-        if is_river_edge:
-            if not river_buffer:
-                return True
-            current_river_name = river_buffer[0].river_name if river_buffer else None
-            is_from_same_river_as_current_buffer = step.source.river_name == current_river_name and step.destination.river_name == current_river_name
-            current_travel_mode = river_buffer[0].travel_mode
-            is_same_travel_mode = step.travel_mode == current_travel_mode
-            return is_from_same_river_as_current_buffer and is_same_travel_mode
-        return False
-
-    def clear_river_buffer():
-        if river_buffer:
-            steps.append(DirectionsStep(
-                river_buffer[0].source,
-                river_buffer[-1].destination,
-                travel_mode = river_buffer[0].travel_mode,
-                distance = sum(step.distance for step in river_buffer),
-                travel_time = sum(step.travel_time for step in river_buffer)
-            ))
-            print(f"Collapsing {len(river_buffer)} segments into {steps[-1]}")
-
-        river_buffer.clear()
-
-    for (i, (segment_source, segment_destination)) in enumerate(windowed(path, 2)):
-        edge_attributes = min(waypoint_graph.graph.get_edge_data(segment_source, segment_destination).values(),
-                              key=lambda x: x[TIME_ATTRIBUTE])
-        step = DirectionsStep(
-            segment_source, segment_destination,
-            travel_mode=edge_attributes[TRAVEL_MODE],
-            distance=edge_attributes[DISTANCE_ATTRIBUTE],
-            travel_time=edge_attributes[TIME_ATTRIBUTE],
-            river_name=segment_source.river_name if isinstance(segment_source, RiverPoint) else None
-        )
-
-        if step.distance == 0:
+    # Hoisted out of the per-hop loop: get_edge_data pays several dict lookups
+    # on every call; each pair has a single attribute dict in a DiGraph
+    adjacency = waypoint_graph._adj
+
+    # Resolve each hop's edge once, dropping zero-length hops
+    hops = []
+    for (segment_source, segment_destination) in zip(path, path[1:]):
+        edge_attributes = adjacency[segment_source.point_id][segment_destination.point_id]
+        if edge_attributes[DISTANCE_ATTRIBUTE] == 0:
+            continue
+        hops.append((segment_source, segment_destination, edge_attributes))
+
+    if not hops:
+        return []
+
+    num_hops = len(hops)
+    distances = np.fromiter(
+        (edge_attributes[DISTANCE_ATTRIBUTE] for (_, _, edge_attributes) in hops),
+        dtype=np.float64, count=num_hops)
+    travel_times = np.fromiter(
+        (edge_attributes[TIME_ATTRIBUTE] for (_, _, edge_attributes) in hops),
+        dtype=np.float64, count=num_hops)
+
+    # Identify runs of consecutive segments along the same river in the same
+    # travel mode; each run collapses into a single step, and every other hop
+    # forms a group of its own
+    group_start_indices = []
+    group_is_river_run = []
+    in_river_run = False
+    run_river_name = None
+    run_travel_mode = None
+    for (hop_index, (source, destination, edge_attributes)) in enumerate(hops):
+        is_river_edge = source.is_river_point and destination.is_river_point
+        extends_run = is_river_edge and (
+            not in_river_run
+            or (source.river_name == run_river_name
+                and destination.river_name == run_river_name
+                and edge_attributes[TRAVEL_MODE] == run_travel_mode))
+        if extends_run and in_river_run:
             continue
+        if extends_run:
+            in_river_run = True
+            run_river_name = source.river_name
+            run_travel_mode = edge_attributes[TRAVEL_MODE]
+        else:
+            in_river_run = False
+        group_start_indices.append(hop_index)
+        group_is_river_run.append(extends_run)
+
+    # Sum each group's distance and travel time columns in one C-level pass
+    group_distances = np.add.reduceat(distances, group_start_indices)
+    group_travel_times = np.add.reduceat(travel_times, group_start_indices)
 
-        if should_extend_river_buffer_with(step):
-            river_buffer.append(step)
+    steps = []
+    group_end_indices = group_start_indices[1:] + [num_hops]
+    for (start, end, is_river_run, distance, travel_time) in zip(
+            group_start_indices, group_end_indices, group_is_river_run,
+            group_distances, group_travel_times):
+        (source, _, edge_attributes) = hops[start]
+        (_, destination, _) = hops[end - 1]
+        if is_river_run:
+            steps.append(DirectionsStep(
+                source, destination,
+                travel_mode=edge_attributes[TRAVEL_MODE],
+                distance=float(distance),
+                travel_time=float(travel_time)))
+            print(f"Collapsing {end - start} segments into {steps[-1]}")
         else:
-            clear_river_buffer()
-            steps.append(step)
-    clear_river_buffer()
+            steps.append(DirectionsStep(
+                source, destination,
+                travel_mode=edge_attributes[TRAVEL_MODE],
+                distance=float(distance),
+                travel_time=float(travel_time),
+                river_name=source.river_name if source.is_river_point else None))
     return steps
 
 
@@ -114,19 +213,21 @@ if __name__ == '__main__':
     world_geography = WorldGeography.from_directory(data_dir)
     waypoint_graph = WaypointGraph.create_from(world_geography)
 
-    print(f"Number of connected components: {networkx.number_strongly_connected_components(waypoint_graph.graph)}")
-
     logging.info("Computing travel times for each segment")
     decorate_with_travel_time_in_place(waypoint_graph.graph, ON_HORSE_AND_ROWING_SPEED_INFO)
 
+    logging.info("Building travel time router")
+    router = TravelTimeRouter.create_from(waypoint_graph.graph, waypoint_graph.points)
+
+    print(f"Number of connected components: {router.number_of_strongly_connected_components()}")
+
     while True:
         print("Enter source city:")
-        source_city = world_geography.city_name_to_city[input()]
+        source_city = world_geography.city_named(input())
         print("Enter destination city:")
-        destination_city = world_geography.city_name_to_city[input()]
+        destination_city = world_geography.city_named(input())
 
-        path = networkx.shortest_path(waypoint_graph.graph, source_city, destination_city,
-                                      weight=TIME_ATTRIBUTE)
+        path = router.shortest_path(source_city, destination_city)
         pretty_print_path(waypoint_graph.graph, path)
 
 
@@ -1,4 +1,5 @@
 from enum import Enum, auto
+from typing import Mapping
 
 from attr import attrs, attrib
 from attr.validators import instance_of
@@ -29,19 +30,25 @@ class SpeedInfo:
     overland_speeds: OverlandSpeedInfo = attrib(validator=instance_of(OverlandSpeedInfo))
     river_speeds: RiverSpeedInfo = attrib(validator=instance_of(RiverSpeedInfo))
     sea_speeds: SeaSpeedInfo = attrib(validator=instance_of(SeaSpeedInfo))
+    # Precomputed so that the per-edge travel time computation is a single multiply
+    # rather than a branch chain plus attribute lookups
+    inverse_speed_by_mode: Mapping[TravelMode, float] = attrib(init=False)
 
     def distance_to_travel_time_in_days(self, *, distance_in_miles: float, travel_mode: TravelMode) -> float:
-        if travel_mode == TravelMode.OVERLAND:
-            return distance_in_miles / self.overland_speeds.overland_speed_in_mile_per_day
-        elif travel_mode == TravelMode.DOWNSTREAM:
-            return distance_in_miles / self.river_speeds.downstream_speed_in_miles_per_day
-        elif travel_mode == TravelMode.UPSTREAM:
-            return distance_in_miles / self.river_speeds.upstream_speed_in_miles_per_day
-        elif travel_mode == TravelMode.SEA:
-            return distance_in_miles / self.sea_speeds.seas_speed_in_miles_per_day
-        else:
+        try:
+            return distance_in_miles * self.inverse_speed_by_mode[travel_mode]
+        except KeyError:
             raise RuntimeError(f"Unknown travel mode {travel_mode}")
 
+    @inverse_speed_by_mode.default
+    def _init_inverse_speed_by_mode(self) -> Mapping[TravelMode, float]:
+        return {
+            TravelMode.OVERLAND: 1.0 / self.overland_speeds.overland_speed_in_mile_per_day,
+            TravelMode.DOWNSTREAM: 1.0 / self.river_speeds.downstream_speed_in_miles_per_day,
+            TravelMode.UPSTREAM: 1.0 / self.river_speeds.upstream_speed_in_miles_per_day,
+            TravelMode.SEA: 1.0 / self.sea_speeds.seas_speed_in_miles_per_day,
+        }
+
 ON_FOOT = OverlandSpeedInfo(overland_speed_in_mile_per_day = 20.0)
 ON_HORSE = OverlandSpeedInfo(overland_speed_in_mile_per_day = 30.0)
 ON_HORSE_URGENT = OverlandSpeedInfo(overland_speed_in_mile_per_day = 67.0)
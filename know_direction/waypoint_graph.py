@@ -1,96 +1,236 @@
 import logging
-from typing import Collection
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Collection, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 import networkx
+import numpy as np
 from attr import attrib, attrs
 from attr.validators import instance_of
-from more_itertools import windowed
 
 from know_direction.travel_speed import TravelMode
-from know_direction.world_geography import WorldGeography, PopulatedPlace, River
+from know_direction.world_geography import GeoPoint, WorldGeography, PopulatedPlace, River, \
+    haversine_miles
+
+
+# A (source, target, attributes) tuple in the form networkx's add_edges_from expects.
+# Nodes are point_id integers: int keys hash trivially and keep the adjacency
+# dicts far smaller than storing the point objects themselves in every edge dict
+Edge = Tuple[int, int, Mapping[str, Any]]
+
+# Enum member access costs an attribute lookup per hit; these run once per edge
+# in the builders below, so bind the members at module level
+_OVERLAND = TravelMode.OVERLAND
+_DOWNSTREAM = TravelMode.DOWNSTREAM
+_UPSTREAM = TravelMode.UPSTREAM
 
 
 @attrs
 class WaypointGraph:
-    graph: networkx.MultiDiGraph = attrib(validator=instance_of(networkx.MultiDiGraph))
+    # A plain DiGraph: one edge per ordered pair, merged on insertion, avoids
+    # MultiDiGraph's extra edge-key dict per pair and per-lookup indirection
+    graph: networkx.DiGraph = attrib(validator=instance_of(networkx.DiGraph))
+    # Translates the graph's integer nodes back to points: points[point_id]
+    points: Sequence[GeoPoint] = attrib()
 
     @staticmethod
     def create_from(world_geography: WorldGeography) -> "WaypointGraph":
-        waypoint_graph = networkx.MultiDiGraph()
+        waypoint_graph = networkx.DiGraph()
 
-        waypoint_graph.add_nodes_from(world_geography.cities)
+        waypoint_graph.add_nodes_from(city.point_id for city in world_geography.cities)
 
         logging.info("Connecting river waypoints")
         WaypointGraph._build_waypoints_from_rivers(world_geography.rivers, waypoint_graph)
 
-        logging.info("Adding city-to-city connections")
-        WaypointGraph._add_city_to_city_connections(world_geography, waypoint_graph)
+        # The three kNN phases only read world_geography and its BallTrees
+        # (whose queries release the GIL), so they can run concurrently; each
+        # returns its edges and the graph is only touched from this thread
+        logging.info("Adding city-to-city, river-to-river and city-to-river connections")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            edge_futures = [
+                executor.submit(edge_phase, world_geography)
+                for edge_phase in (WaypointGraph._city_to_city_edges,
+                                   WaypointGraph._river_to_river_edges,
+                                   WaypointGraph._city_river_edges)
+            ]
+            for edge_future in edge_futures:
+                WaypointGraph._add_edges_keeping_shortest(waypoint_graph,
+                                                          edge_future.result())
+
+        # The structure is complete; freezing lets networkx skip mutation
+        # bookkeeping on reads (edge attributes stay writable for decoration)
+        networkx.freeze(waypoint_graph)
+        return WaypointGraph(waypoint_graph, world_geography.points)
 
-        logging.info("Adding connections between rivers and rivers")
-        WaypointGraph._add_river_to_river_connections(world_geography=world_geography,
-                                                      waypoint_graph=waypoint_graph)
-
-        logging.info("Adding connections between rivers and cities")
-        WaypointGraph._add_city_river_connections(world_geography=world_geography,
-                                                  waypoint_graph=waypoint_graph)
-        return WaypointGraph(waypoint_graph)
 
+    @staticmethod
+    def _add_edges_keeping_shortest(waypoint_graph: networkx.DiGraph,
+                                    edges: Iterable[Edge]) -> None:
+        """
+        Like `add_edges_from`, except that when an ordered pair already has an
+        edge the shorter of the two survives instead of the later one.
+
+        Ties keep the existing edge, so the river segments added first win over
+        a coincident overland connection; with river travel at least as fast as
+        overland that is also the time-optimal choice.
+        """
+        get_edge_data = waypoint_graph.get_edge_data
+        add_edge = waypoint_graph.add_edge
+        for (source, target, attributes) in edges:
+            existing_attributes = get_edge_data(source, target)
+            if (existing_attributes is None
+                    or attributes["distance"] < existing_attributes["distance"]):
+                add_edge(source, target, **attributes)
 
     @staticmethod
-    def add_overland_connection(point1, point2, waypoint_graph):
-        distance_between_cities = point1.distance_to(point2)
-        waypoint_graph.add_edge(point1, point2, distance=distance_between_cities,
-                                travel_mode=TravelMode.OVERLAND)
-        waypoint_graph.add_edge(point2, point1, distance=distance_between_cities,
-                                travel_mode=TravelMode.OVERLAND)
+    def _overland_edge_pair(point1: GeoPoint, point2: GeoPoint,
+                            distance: Optional[float] = None) -> Tuple[Edge, Edge]:
+        """
+        The two directed edge tuples of an overland connection, for bulk insertion
+        via `add_edges_from`.
+        """
+        if distance is None:
+            distance = point1.distance_to(point2)
+        return ((point1.point_id, point2.point_id,
+                 {"distance": distance, "travel_mode": _OVERLAND}),
+                (point2.point_id, point1.point_id,
+                 {"distance": distance, "travel_mode": _OVERLAND}))
 
     @staticmethod
-    def _add_city_to_city_connections(world_geography: WorldGeography,
-                                      waypoint_graph: networkx.DiGraph) -> None:
-        # We connect each city to the 30 closest cities
-        for city in world_geography.cities:
-            for other_city in world_geography.city_proximity.closest_n_points_to(city, 30):
-                if city != other_city:
-                    WaypointGraph.add_overland_connection(city, other_city, waypoint_graph)
+    def _city_to_city_edges(world_geography: WorldGeography) -> List[Edge]:
+        # We connect each city to the 30 closest cities. Querying the proximity
+        # index with its own point tuple reuses its prebuilt coordinate matrix
+        city_proximity = world_geography.city_proximity
+        cities = city_proximity.points
+        (neighbor_indices, neighbor_distances) = \
+            city_proximity.closest_n_indices_with_distances_to_many(cities, 30)
+
+        # Flatten the (N, 30) results into parallel source/target/distance
+        # arrays, then drop self-pairs and the duplicate direction of each
+        # symmetric pair entirely in NumPy; only the surviving pairs reach
+        # the Python loop that materializes edge tuples
+        num_cities = len(cities)
+        source_indices = np.repeat(np.arange(num_cities), neighbor_indices.shape[1])
+        target_indices = neighbor_indices.ravel()
+        distances = neighbor_distances.ravel()
+
+        not_self = source_indices != target_indices
+        pair_keys = (np.minimum(source_indices, target_indices) * num_cities
+                     + np.maximum(source_indices, target_indices))
+        (_, first_occurrences) = np.unique(pair_keys[not_self], return_index=True)
+
+        edges = []
+        overland_edge_pair = WaypointGraph._overland_edge_pair
+        for (source_index, target_index, distance) in zip(
+                source_indices[not_self][first_occurrences].tolist(),
+                target_indices[not_self][first_occurrences].tolist(),
+                distances[not_self][first_occurrences].tolist()):
+            edges.extend(overland_edge_pair(
+                cities[source_index], cities[target_index], distance=distance))
+        return edges
 
 
     @staticmethod
-    def _add_city_river_connections(*, world_geography: WorldGeography,
-                                   waypoint_graph: networkx.DiGraph) -> None:
-        for city in world_geography.cities:
-            # We connect each city to the 30 closest river end points
-            for river_end_point in world_geography.river_endpoints_proximity.closest_n_points_to(city, 30):
-                WaypointGraph.add_overland_connection(city, river_end_point, waypoint_graph)
-        for river in world_geography.rivers:
-            for river_end_point in (river.start, river.end):
-                # For each river endpoint, we connect it to its closest 30 cities
-                for city in world_geography.city_proximity.closest_n_points_to(river_end_point, 30):
-                    WaypointGraph.add_overland_connection(city, river_end_point, waypoint_graph)
+    def _city_river_edges(world_geography: WorldGeography) -> List[Edge]:
+        edges = []
+
+        # Hoist the attribute chains and helper lookups the inner loops would
+        # otherwise repeat per neighbor
+        city_proximity = world_geography.city_proximity
+        river_endpoints_proximity = world_geography.river_endpoints_proximity
+        overland_edge_pair = WaypointGraph._overland_edge_pair
+
+        # kNN is not symmetric, so both query directions are needed for full
+        # coverage, but a pair found from both sides is the same connection;
+        # canonicalize each pair and add its edges once, as in the city phase
+        seen_pairs = set()
+
+        # We connect each city to the 30 closest river end points
+        cities = city_proximity.points
+        endpoints_per_city = river_endpoints_proximity.closest_n_points_with_distances_to_many(
+            cities, 30)
+        for (city, (river_end_points, distances)) in zip(cities, endpoints_per_city):
+            for (river_end_point, distance) in zip(river_end_points, distances):
+                pair_key = (id(city), id(river_end_point)) if id(city) < id(river_end_point) \
+                    else (id(river_end_point), id(city))
+                if pair_key in seen_pairs:
+                    continue
+                seen_pairs.add(pair_key)
+                edges.extend(overland_edge_pair(city, river_end_point,
+                                                distance=float(distance)))
+
+        # For each river endpoint, we connect it to its closest 30 cities
+        river_end_points = river_endpoints_proximity.points
+        cities_per_endpoint = city_proximity.closest_n_points_with_distances_to_many(
+            river_end_points, 30)
+        for (river_end_point, (nearby_cities, distances)) in zip(river_end_points, cities_per_endpoint):
+            for (city, distance) in zip(nearby_cities, distances):
+                pair_key = (id(city), id(river_end_point)) if id(city) < id(river_end_point) \
+                    else (id(river_end_point), id(city))
+                if pair_key in seen_pairs:
+                    continue
+                seen_pairs.add(pair_key)
+                edges.extend(overland_edge_pair(river_end_point, city,
+                                                distance=float(distance)))
+
+        return edges
 
     @staticmethod
-    def _add_river_to_river_connections(*,
-                                        waypoint_graph: networkx.DiGraph,
-                                        world_geography: WorldGeography) -> None:
-        for river in world_geography.rivers:
-            # We connect each river endpoint to its 10 closest other river endpoints,
-            # at most one of which can be from the same river
-            for other_river_endpoint in world_geography.river_endpoints_proximity.closest_n_points_to(river.start, 10):
-                WaypointGraph.add_overland_connection(river.start, other_river_endpoint, waypoint_graph)
-            for other_river_endpoint in world_geography.river_endpoints_proximity.closest_n_points_to(river.end, 10):
-                WaypointGraph.add_overland_connection(river.end, other_river_endpoint, waypoint_graph)
+    def _river_to_river_edges(world_geography: WorldGeography) -> List[Edge]:
+        edges = []
+        # We connect each river endpoint to its 10 closest other river endpoints,
+        # at most one of which can be from the same river. The endpoint itself is
+        # in the proximity index, so query one extra neighbor and skip it rather
+        # than adding a zero-length self connection. Querying with the index's
+        # own point tuple reuses its prebuilt coordinate matrix
+        river_endpoints_proximity = world_geography.river_endpoints_proximity
+        river_endpoints = river_endpoints_proximity.points
+        neighbors_per_endpoint = river_endpoints_proximity.closest_n_points_with_distances_to_many(
+            river_endpoints, 11)
+        overland_edge_pair = WaypointGraph._overland_edge_pair
+        # Nearby endpoints usually appear in each other's neighbor lists;
+        # canonicalize each pair and add its edges once, as in the city phase
+        seen_pairs = set()
+        for (river_endpoint, (neighbors, distances)) in zip(river_endpoints, neighbors_per_endpoint):
+            for (other_river_endpoint, distance) in zip(neighbors, distances):
+                if other_river_endpoint is river_endpoint:
+                    continue
+                pair_key = (id(river_endpoint), id(other_river_endpoint)) \
+                    if id(river_endpoint) < id(other_river_endpoint) \
+                    else (id(other_river_endpoint), id(river_endpoint))
+                if pair_key in seen_pairs:
+                    continue
+                seen_pairs.add(pair_key)
+                edges.extend(overland_edge_pair(river_endpoint,
+                                                other_river_endpoint,
+                                                distance=float(distance)))
+        return edges
 
     @staticmethod
     def _build_waypoints_from_rivers(rivers: Collection[River], waypoint_graph: networkx.DiGraph) -> None:
+        edges = []
         for river in rivers:
-            waypoint_graph.add_nodes_from(river.points_in_direction_of_water_flow)
-            for (river_segment_source, river_segment_destination) in windowed(river.points_in_direction_of_water_flow, 2):
-                segment_distance = river_segment_source.distance_to(river_segment_destination)
-                waypoint_graph.add_edge(
-                    river_segment_source, river_segment_destination, travel_mode=TravelMode.DOWNSTREAM,
-                    distance=segment_distance)
-                waypoint_graph.add_edge(
-                    river_segment_destination, river_segment_source, travel_mode=TravelMode.UPSTREAM,
-                    distance=segment_distance)
+            river_points = tuple(river.points_in_direction_of_water_flow)
+            waypoint_graph.add_nodes_from(point.point_id for point in river_points)
+
+            # All of a river's consecutive-segment distances in one vectorized pass
+            num_points = len(river_points)
+            latitudes = np.fromiter((point.latitude_radians for point in river_points),
+                                    dtype=np.float64, count=num_points)
+            longitudes = np.fromiter((point.longitude_radians for point in river_points),
+                                     dtype=np.float64, count=num_points)
+            segment_distances = haversine_miles(latitudes[:-1], longitudes[:-1],
+                                                latitudes[1:], longitudes[1:])
+
+            # Consecutive pairing via slicing runs entirely in C, unlike
+            # more_itertools.windowed's per-step generator machinery
+            for (river_segment_source, river_segment_destination, segment_distance) in zip(
+                    river_points, river_points[1:], segment_distances):
+                segment_distance = float(segment_distance)
+                edges.append((river_segment_source.point_id, river_segment_destination.point_id,
+                              {"distance": segment_distance, "travel_mode": _DOWNSTREAM}))
+                edges.append((river_segment_destination.point_id, river_segment_source.point_id,
+                              {"distance": segment_distance, "travel_mode": _UPSTREAM}))
+        waypoint_graph.add_edges_from(edges)
 
 
 
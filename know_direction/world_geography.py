@@ -1,39 +1,87 @@
 import logging
+import pickle
 from collections import defaultdict
 from math import sin, cos, asin, sqrt
 from math import radians
 from pathlib import Path
 from typing import Collection, Optional, Sequence, Mapping, List, Tuple, TypeVar, Generic, Iterable
 
+import numpy as np
 from attr import attrs, attrib, Factory
-from attr.validators import deep_iterable, instance_of, optional
-from fastkml import kml
+from attr.validators import deep_iterable, instance_of
+from lxml import etree
 from sklearn.neighbors import BallTree
 
 
-@attrs(kw_only=True, eq=False)
+EARTH_RADIUS_IN_MILES = 3958.8
+
+
+def haversine_miles(latitudes1_radians, longitudes1_radians,
+                    latitudes2_radians, longitudes2_radians) -> np.ndarray:
+    """
+    Vectorized great-circle distance between arrays of coordinates in radians.
+
+    The arguments broadcast against each other, so passing e.g. `latitudes[:, None]`
+    and `latitudes[None, :]` yields the full pairwise distance matrix.
+    """
+    dlat = latitudes2_radians - latitudes1_radians
+    dlon = longitudes2_radians - longitudes1_radians
+    a = (np.sin(dlat / 2) ** 2
+         + np.cos(latitudes1_radians) * np.cos(latitudes2_radians) * np.sin(dlon / 2) ** 2)
+    return EARTH_RADIUS_IN_MILES * 2 * np.arcsin(np.sqrt(a))
+
+
+def haversine_miles_scalar(latitude1_radians: float, longitude1_radians: float,
+                           latitude2_radians: float, longitude2_radians: float) -> float:
+    """
+    Scalar counterpart of `haversine_miles` for a single pair of coordinates
+    already in radians; `math` beats NumPy on single values.
+
+    From https://stackoverflow.com/a/15737218
+    """
+    dlat = latitude2_radians - latitude1_radians
+    dlon = longitude2_radians - longitude1_radians
+    a = sin(dlat / 2) ** 2 + cos(latitude1_radians) * cos(latitude2_radians) * sin(dlon / 2) ** 2
+    return EARTH_RADIUS_IN_MILES * 2 * asin(sqrt(a))
+
+
+# These classes are constructed once per KML point, so they are slotted and skip
+# attrs validators to keep per-instance construction cost and memory down
+@attrs(kw_only=True, eq=False, slots=True)
 class GeoPoint:
-    latitude: float = attrib(validator=instance_of(float))
-    longitude: float = attrib(validator=instance_of(float))
+    latitude: float = attrib()
+    longitude: float = attrib()
     latitude_radians: float = attrib(init=False)
     longitude_radians: float =attrib(init=False)
+    # (latitude, longitude) in radians as a ready-made ndarray, so kNN query
+    # matrices stack cached arrays instead of converting tuples per query
+    coordinates_radians: np.ndarray = attrib(init=False)
+    # Position in WorldGeography.points; integer node keys keep the waypoint
+    # graph's internal dicts small and cheap to hash
+    point_id: Optional[int] = attrib(init=False, default=None)
+
+    # Points are keyed by identity in the waypoint graph's node and adjacency
+    # dicts; keep the C-level object hash rather than any Python-level one
+    __hash__ = object.__hash__
+
+    # Class-level flag so per-hop checks are an attribute load, not an
+    # isinstance MRO walk; RiverPoint overrides it
+    is_river_point = False
 
     def pretty_string(self) -> str:
         return f"({self.latitude:.2f}, {self.latitude:.2f})"
 
-    def distance_to(self, target: "GeoPoint") -> float:
+    def distances_to_many(self, latitudes_radians: np.ndarray,
+                          longitudes_radians: np.ndarray) -> np.ndarray:
         """
-        From https://stackoverflow.com/a/15737218
+        Vectorized `distance_to` against arrays of coordinates in radians.
         """
-        # convert decimal degrees to radians
-        lon1, lat1, lon2, lat2 = map(radians, [self.longitude, self.latitude, target.longitude, target.latitude])
-        # haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        # Radius of earth in miles is 3958.8
-        return 3958.8 * c
+        return haversine_miles(self.latitude_radians, self.longitude_radians,
+                               latitudes_radians, longitudes_radians)
+
+    def distance_to(self, target: "GeoPoint") -> float:
+        return haversine_miles_scalar(self.latitude_radians, self.longitude_radians,
+                                      target.latitude_radians, target.longitude_radians)
 
     @latitude_radians.default
     def _init_latitude_radians(self) -> float:
@@ -43,21 +91,26 @@ class GeoPoint:
     def _init_longitude_radians(self) -> float:
         return radians(self.longitude)
 
+    @coordinates_radians.default
+    def _init_coordinates_radians(self) -> np.ndarray:
+        return np.array((self.latitude_radians, self.longitude_radians), dtype=np.float64)
+
 
-@attrs(kw_only=True, eq=False)
+@attrs(kw_only=True, eq=False, slots=True)
 class RiverPoint(GeoPoint):
-    river_name: Optional[str] = attrib(validator=optional(instance_of(str)))
+    river_name: Optional[str] = attrib()
+
+    is_river_point = True
 
     def pretty_string(self) -> str:
         return self.river_name or "Unnamed river"
 
 
-@attrs(kw_only=True, eq=False)
+@attrs(kw_only=True, eq=False, slots=True)
 class River:
-    name: Optional[str] = attrib(validator=optional(instance_of(str)))
-    points_in_direction_of_water_flow: Sequence[RiverPoint] = attrib(
-        validator=deep_iterable(instance_of(RiverPoint))
-    )
+    name: Optional[str] = attrib()
+    # No deep_iterable validator: it walks every river point on construction
+    points_in_direction_of_water_flow: Sequence[RiverPoint] = attrib()
     start: RiverPoint = attrib(default=Factory(lambda self: self.points_in_direction_of_water_flow[0],
                                                takes_self=True))
     end: RiverPoint = attrib(default=Factory(lambda self: self.points_in_direction_of_water_flow[-1],
@@ -66,78 +119,73 @@ class River:
 
     @staticmethod
     def load_rivers(river_kml_path: Path) -> Collection["River"]:
-        logging.info("Loading rivers from %s", river_kml_path)
-        river_kml = load_kml(river_kml_path)
-
-        top_level_features = tuple(river_kml.features())
-        if len(top_level_features) != 1:
-            raise RuntimeError("Expected a single root document element")
+        # The XML parse dominates startup, so reuse the pickled result of a
+        # previous run as long as the KML file is unchanged
+        cached_rivers = _load_parse_cache(river_kml_path)
+        if cached_rivers is not None:
+            logging.info("Loaded %s rivers from cache for %s", len(cached_rivers), river_kml_path)
+            return cached_rivers
 
-        document_root = top_level_features[0]
-        document_children = tuple(document_root.features())
-
-        if len(document_children) != 1:
-            raise RuntimeError("Expected a single folder of river")
-
-        river_folder = document_children[0]
-
-        rivers = []
+        logging.info("Loading rivers from %s", river_kml_path)
 
-        for river_placemark in river_folder.features():
-            river_coordinates = river_placemark.geometry.coords
+        # Pull the raw rows out of the KML stream first, so point construction
+        # is a tight comprehension instead of interleaving with XML parsing
+        river_rows = []
+        for (river_name, river_coordinates) in _iter_kml_placemarks(river_kml_path):
             if len(river_coordinates) < 2:
                 raise RuntimeError("A river must have at least two points")
-            river_points = [
-                RiverPoint(latitude=latitude, longitude=longitude, river_name=river_placemark.name)
-                for (latitude, longitude, _) in river_coordinates
-            ]
-            rivers.append(River(name=river_placemark.name, points_in_direction_of_water_flow=river_points))
+            river_rows.append((river_name, river_coordinates))
+
+        rivers = [
+            River(name=river_name,
+                  points_in_direction_of_water_flow=[
+                      RiverPoint(latitude=latitude, longitude=longitude, river_name=river_name)
+                      for (latitude, longitude, _) in river_coordinates
+                  ])
+            for (river_name, river_coordinates) in river_rows
+        ]
 
         logging.info("Loaded %s rivers", len(rivers))
+        _store_parse_cache(river_kml_path, rivers)
         return rivers
 
 
-@attrs(kw_only=True, eq=False)
+@attrs(kw_only=True, eq=False, slots=True)
 class PopulatedPlace(GeoPoint):
-    name: str = attrib(validator=instance_of(str))
-    population: Optional[int] = attrib(validator=optional(instance_of(int)))
+    name: str = attrib()
+    population: Optional[int] = attrib()
 
     def pretty_string(self) -> str:
         return self.name
 
     @staticmethod
     def load_cities(city_kml_path: Path) -> Collection["PopulatedPlace"]:
-        logging.info("Loading cities from %s...", city_kml_path)
-
-        city_kml = load_kml(city_kml_path)
-
-        top_level_features = tuple(city_kml.features())
-        if len(top_level_features) != 1:
-            raise RuntimeError("Expected a single root document element")
-
-        document_root = top_level_features[0]
-        document_children = tuple(document_root.features())
-
-        if len(document_children) != 1:
-            raise RuntimeError("Expected a single folder of cities")
-
-        city_folder = document_children[0]
+        # The XML parse dominates startup, so reuse the pickled result of a
+        # previous run as long as the KML file is unchanged
+        cached_cities = _load_parse_cache(city_kml_path)
+        if cached_cities is not None:
+            logging.info("Loaded %s cities from cache for %s", len(cached_cities), city_kml_path)
+            return cached_cities
 
-        cities = []
+        logging.info("Loading cities from %s...", city_kml_path)
 
-        for city_placemark in city_folder.features():
-            city_coordinates = city_placemark.geometry.coords
+        # Pull the raw rows out of the KML stream first, so city construction
+        # is a tight comprehension instead of interleaving with XML parsing
+        city_rows = []
+        for (city_name, city_coordinates) in _iter_kml_placemarks(city_kml_path):
             if len(city_coordinates) != 1:
                 raise RuntimeError("Expected a city to have only one set of coordinates")
-            city_point = city_coordinates[0]
-            (latitiude, longitude, population) = city_point
-            cities.append(PopulatedPlace(name=city_placemark.name,
-                                         population=int(population) if population else None,
-                                         latitude=latitiude,
-                                         longitude=longitude))
+            city_rows.append((city_name, *city_coordinates[0]))
+
+        cities = [PopulatedPlace(name=name,
+                                 population=int(population) if population else None,
+                                 latitude=latitiude,
+                                 longitude=longitude)
+                  for (name, latitiude, longitude, population) in city_rows]
 
         logging.info("Loaded %s cities", len(cities))
 
+        _store_parse_cache(city_kml_path, cities)
         return cities
 
 
@@ -147,30 +195,89 @@ _T = TypeVar(name="_T", bound=GeoPoint)
 @attrs
 class GeoPointProximity(Generic[_T]):
     _ball_tree: BallTree = attrib(validator=instance_of(BallTree))
-    _geopoints = attrib(validator=deep_iterable(instance_of(GeoPoint)))
+    # No deep_iterable validator: it would isinstance-check every indexed point
+    _geopoints = attrib()
+    # The (N, 2) matrix the tree was built from, kept so that querying the
+    # tree with its own points never rebuilds it
+    _coordinates_radians: np.ndarray = attrib()
 
     @staticmethod
     def create_from(points: Iterable[_T]) -> "GeoPointProximity[_T]":
         geopoints = tuple(points)
-        geopoint_coordinates_in_radians = [(point.latitude_radians, point.longitude_radians)
-                                           for point in geopoints]
+        coordinates_radians = np.stack([point.coordinates_radians for point in geopoints])
 
+        # Larger leaves than the sklearn default of 40 favor the batched 30-NN
+        # queries this index serves: shallower descent and longer contiguous
+        # leaf scans, at the cost of a few extra distance computations
+        leaf_size = min(256, max(40, len(geopoints) // 64))
         return GeoPointProximity(
-            BallTree(data=tuple(geopoint_coordinates_in_radians), metric="haversine"),
-            geopoints
+            BallTree(data=coordinates_radians, metric="haversine", leaf_size=leaf_size),
+            geopoints,
+            coordinates_radians
         )
 
+    @property
+    def points(self) -> Sequence[_T]:
+        """
+        The indexed points, in tree order; querying with exactly this sequence
+        reuses the tree's own coordinate matrix.
+        """
+        return self._geopoints
+
     def closest_n_points_to(self, query_point: GeoPoint, num_points: int) -> Collection[_T]:
-        query_point_radians = (query_point.latitude_radians, query_point.longitude_radians)
-        nearby_point_indices = self._ball_tree.query([query_point_radians], k=num_points,
-                                              return_distance=False)
+        nearby_point_indices = self._ball_tree.query(query_point.coordinates_radians[None, :],
+                                                     k=num_points, return_distance=False)
         return tuple(self._geopoints[idx] for idx in nearby_point_indices[0])
 
+    def closest_n_points_to_many(self, query_points: Sequence[GeoPoint],
+                                 num_points: int) -> Sequence[Collection[_T]]:
+        """
+        Like `closest_n_points_to`, but answers all queries in a single BallTree call.
+        """
+        nearby_point_indices = self._ball_tree.query(self._query_radians(query_points),
+                                                     k=num_points, return_distance=False)
+        return tuple(tuple(self._geopoints[idx] for idx in point_indices)
+                     for point_indices in nearby_point_indices)
+
+    def closest_n_points_with_distances_to_many(
+            self, query_points: Sequence[GeoPoint],
+            num_points: int) -> Sequence[Tuple[Collection[_T], np.ndarray]]:
+        """
+        Like `closest_n_points_to_many`, but each query's result also carries the
+        neighbors' great-circle distances in miles, which the haversine BallTree
+        computes during the search anyway.
+        """
+        (distances_radians, nearby_point_indices) = self._ball_tree.query(
+            self._query_radians(query_points), k=num_points, return_distance=True)
+        distances_miles = distances_radians * EARTH_RADIUS_IN_MILES
+        return tuple(
+            (tuple(self._geopoints[idx] for idx in point_indices), point_distances)
+            for (point_indices, point_distances) in zip(nearby_point_indices, distances_miles))
+
+    def closest_n_indices_with_distances_to_many(
+            self, query_points: Sequence[GeoPoint],
+            num_points: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Raw (num_queries, num_points) arrays of neighbor indices into `points`
+        and distances in miles, for callers that post-process the results with
+        NumPy rather than walking point objects.
+        """
+        (distances_radians, nearby_point_indices) = self._ball_tree.query(
+            self._query_radians(query_points), k=num_points, return_distance=True)
+        return (nearby_point_indices, distances_radians * EARTH_RADIUS_IN_MILES)
+
+    def _query_radians(self, query_points: Sequence[GeoPoint]) -> np.ndarray:
+        if query_points is self._geopoints:
+            return self._coordinates_radians
+        return np.stack([query_point.coordinates_radians for query_point in query_points])
+
 
 @attrs
 class WorldGeography:
     cities: Collection[PopulatedPlace] = attrib(validator=deep_iterable(instance_of(PopulatedPlace)))
     rivers: Collection[River] =attrib(validator=deep_iterable(instance_of(River)))
+    # Registry of every point in the world; each point's point_id is its index here
+    points: Sequence[GeoPoint] = attrib(init=False)
     city_name_to_city: Mapping[str, PopulatedPlace] = attrib(init=False)
     city_proximity: GeoPointProximity[PopulatedPlace] = attrib(
         init=False,
@@ -182,10 +289,24 @@ class WorldGeography:
         return WorldGeography(cities=PopulatedPlace.load_cities(data_directory / "golarion_city.kml"),
                               rivers=River.load_rivers(data_directory / "innersea_rivers.kml"))
 
+    @points.default
+    def _init_points(self) -> Sequence[GeoPoint]:
+        points = tuple(self.cities) + tuple(
+            point
+            for river in self.rivers
+            for point in river.points_in_direction_of_water_flow)
+        for (index, point) in enumerate(points):
+            point.point_id = index
+        return points
+
+    def city_named(self, name: str) -> PopulatedPlace:
+        return self.city_name_to_city[name.casefold()]
+
     @city_name_to_city.default
     def _init_city_name_to_city(self) -> Mapping[str, PopulatedPlace]:
+        # Keyed casefolded so lookups are insensitive to how the user typed the name
         return {
-            city.name : city for city in self.cities
+            city.name.casefold() : city for city in self.cities
         }
 
     @river_endpoints_proximity.default
@@ -194,10 +315,71 @@ class WorldGeography:
             [river.start for river in self.rivers] + [river.end for river in self.rivers])
 
 
-def load_kml(city_kml_path: Path) -> kml.KML:
-    raw_city_kml = city_kml_path.read_text(encoding="utf-8")
-    city_kml = kml.KML()
-    city_kml.from_string(raw_city_kml.encode(encoding="utf-8"))
-    return city_kml
+def _parse_cache_path(kml_path: Path) -> Path:
+    return kml_path.with_suffix(kml_path.suffix + ".cache.pkl")
+
+
+# Bump whenever the pickled point classes change shape: slotted attrs classes
+# pickle positionally, so a cache from an older layout would otherwise unpickle
+# "successfully" with fields shifted into the wrong slots
+_PARSE_CACHE_VERSION = 1
+
+
+def _load_parse_cache(kml_path: Path):
+    """
+    The parsed points from a previous run of this KML file, or None if there is
+    no cache or it is stale — written from a changed KML file, by a different
+    cache-format version, or simply unreadable.
+    """
+    cache_path = _parse_cache_path(kml_path)
+    if not cache_path.exists():
+        return None
+    try:
+        with cache_path.open("rb") as cache_file:
+            (source_stamp, parsed) = pickle.load(cache_file)
+    except Exception:
+        # A cache that cannot be unpickled — truncated, corrupt, or referring
+        # to renamed classes — is just a miss; reparsing rewrites it
+        return None
+    kml_stat = kml_path.stat()
+    if source_stamp != (_PARSE_CACHE_VERSION, kml_stat.st_mtime, kml_stat.st_size):
+        return None
+    return parsed
+
+
+def _store_parse_cache(kml_path: Path, parsed) -> None:
+    kml_stat = kml_path.stat()
+    with _parse_cache_path(kml_path).open("wb") as cache_file:
+        pickle.dump(((_PARSE_CACHE_VERSION, kml_stat.st_mtime, kml_stat.st_size), parsed),
+                    cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+_KML_NAMESPACE = "{http://www.opengis.net/kml/2.2}"
+
+
+def _iter_kml_placemarks(
+        kml_path: Path) -> Iterable[Tuple[Optional[str], Sequence[Tuple[float, ...]]]]:
+    """
+    Stream (name, coordinate rows) for every Placemark in a KML file.
+
+    Coordinate fields are yielded in file order, the same order the old
+    fastkml-based loader surfaced them in. lxml's iterparse only ever holds one
+    Placemark subtree in memory instead of the whole document.
+    """
+    for (_, placemark) in etree.iterparse(str(kml_path), events=("end",),
+                                          tag=_KML_NAMESPACE + "Placemark"):
+        coordinates_text = placemark.findtext(f".//{_KML_NAMESPACE}coordinates")
+        if coordinates_text is None:
+            raise RuntimeError("Expected every placemark to have coordinates")
+        coordinate_rows = tuple(
+            tuple(float(field) for field in entry.split(","))
+            for entry in coordinates_text.split())
+        yield (placemark.findtext(_KML_NAMESPACE + "name"), coordinate_rows)
+
+        # Release the consumed subtree and any preceding siblings so the
+        # parse stays bounded-memory
+        placemark.clear()
+        while placemark.getprevious() is not None:
+            del placemark.getparent()[0]
 
 